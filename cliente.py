@@ -16,7 +16,7 @@ import os
 import sys
 import textwrap
 from docopt import docopt
-from tftp import get_file, put_file, dir_file, check_remote_file
+from tftp import get_file, put_file, dir_file, check_remote_file, SocketPool
 from utils import check_server, resolve_server_address
 
 def main():
@@ -46,10 +46,10 @@ def main():
         local_file = args["<local_file>"]
         if args["<local_file>"] == None:
             local_file = args["<remote_file>"]
-        if not check_remote_file(server, server_port, remote_file):
+        if not check_remote_file(server_ip, server_port, remote_file):
             print(f"Error: The remote file '{remote_file}' does not exist on the server.")
             sys.exit(1)
-        if get_file(server, server_port, remote_file, local_file) == True:
+        if get_file(server_ip, server_port, remote_file, local_file) == True:
             print(f"File '{remote_file}' downloaded as '{local_file}'")
 
     elif args["put"]:
@@ -60,7 +60,7 @@ def main():
         if not os.path.exists(local_file):
             print(f"Error: The local file '{local_file}' does not exist.")
             sys.exit(1)
-        if put_file(server, server_port, local_file, remote_file) == True:
+        if put_file(server_ip, server_port, local_file, remote_file) == True:
             print(f"File '{local_file}' uploaded as '{remote_file}'")
 
     else:
@@ -90,8 +90,13 @@ def exec_tftp_shell(server_name, server_port, server_ip):
   \033[1mPort:\033[0m {server_port}
 """)
 
+    # Sockets for the transfers are created between commands, before
+    # the prompt, so that no transfer waits for one
+    sockets = SocketPool()
+
     while True:
         try:
+            sockets.refill()
             cmd = input("\033[1mTftp client>\033[0m ")
 
             if cmd.startswith("get"):
@@ -105,11 +110,11 @@ def exec_tftp_shell(server_name, server_port, server_ip):
                 if check_server(server_name, server_port) == True:
                     continue
 
-                if not check_remote_file(server_name, server_port, remote_file):
+                if not check_remote_file(server_ip, server_port, remote_file, sock=sockets.take()):
                     print(f"\033[41mError:\033[0m The remote file '{remote_file}' does not exist on the server.")
                     continue
 
-                if get_file(server_ip, server_port, remote_file, local_file) == True:
+                if get_file(server_ip, server_port, remote_file, local_file, sock=sockets.take()) == True:
                     print(f"File '{remote_file}' downloaded as '{local_file}'")
 
             elif cmd.startswith("put"):
@@ -126,16 +131,11 @@ def exec_tftp_shell(server_name, server_port, server_ip):
                 if check_server(server_name, server_port) == True:
                     continue
 
-                if put_file(server_name, server_port, local_file, remote_file) == True:
+                if put_file(server_ip, server_port, local_file, remote_file, sock=sockets.take()) == True:
                     print(f"File '{local_file}' uploaded as '{remote_file}'")
 
             elif cmd == "dir":
-                dir_file(server_name, server_port)
-                 # Add functionality to show file content
-                with open('list.txt', 'rb') as f:
-                    print(f.read().decode('utf-8'))       
-                    # Delete the file afterwards
-                    os.remove('list.txt')
+                print(dir_file(server_ip, server_port, sock=sockets.take()).decode('utf-8'))
 
             elif cmd == "help":
                 print(
@@ -153,6 +153,7 @@ def exec_tftp_shell(server_name, server_port, server_ip):
             elif cmd == "quit":
                 print("Exiting the Tftp client.")
                 print(f"\033[1;33mGoodbye!\033[0m")
+                sockets.close()
                 sys.exit(0)
 
             else:
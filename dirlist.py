@@ -1,7 +1,21 @@
+import ctypes
+import ctypes.util
+import grp
+import math
 import os
-import subprocess
+import pwd
+import stat
+import struct
 import time
 
+# inotify(7) events that change the directory listing
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = struct.Struct('iIII')   # wd, mask, cookie, len
+
 def extract_tftp_directory(file_path):
     try:
         with open(file_path, "r") as file:
@@ -12,30 +26,104 @@ def extract_tftp_directory(file_path):
         print(f"File {file_path} not found.")
     return None
 
+def human_size(size):
+    # Same rounding as 'ls -h': up, and with one decimal below 10
+    if size < 1024:
+        return str(size)
+    for unit in "KMGTPE":
+        size /= 1024
+        if size < 10:
+            return f"{math.ceil(size * 10) / 10:.1f}{unit}"
+        if size < 1024 or unit == "E":
+            return f"{math.ceil(size)}{unit}"
+
+def format_entry(entry, now, owners, groups):
+    st = entry.stat(follow_symlinks=False)
+    if st.st_uid not in owners:
+        try:
+            owners[st.st_uid] = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            owners[st.st_uid] = str(st.st_uid)
+    if st.st_gid not in groups:
+        try:
+            groups[st.st_gid] = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            groups[st.st_gid] = str(st.st_gid)
+    # Like 'ls', the year replaces the time for files older than 6 months
+    if now - st.st_mtime < 182 * 24 * 3600:
+        mtime = time.strftime("%b %e %H:%M", time.localtime(st.st_mtime))
+    else:
+        mtime = time.strftime("%b %e  %Y", time.localtime(st.st_mtime))
+    name = entry.name
+    if entry.is_symlink():
+        name += " -> " + os.readlink(entry.path)
+    line = (stat.filemode(st.st_mode), st.st_nlink, owners[st.st_uid],
+            groups[st.st_gid], human_size(st.st_size), mtime, name)
+    return st.st_blocks, line
+
 def execute_ls_command(directory, save_list_path):
+    # Same listing as 'ls -Alh', without forking 'ls'
     try:
+        now = time.time()
+        owners, groups = {}, {}
+        with os.scandir(directory) as entries:
+            listed = sorted(
+                (format_entry(entry, now, owners, groups) for entry in entries),
+                key=lambda listed_entry: listed_entry[1][-1],
+            )
+        total_blocks = sum(blocks for blocks, _ in listed)
+        lines = [line for _, line in listed]
+        widths = [max((len(str(line[col])) for line in lines), default=0) for col in range(5)]
         with open(save_list_path, "w") as save_list:
-            subprocess.run(["ls", "-Alh", directory], check=True, stdout=save_list, stderr=subprocess.PIPE)
-        print("Executed ls command.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing ls command: {e}")
+            save_list.write(f"total {human_size(total_blocks * 512)}\n")
+            for line in lines:
+                mode, nlink, owner, group, size, mtime, name = line
+                save_list.write(
+                    f"{mode} {nlink:>{widths[1]}} {owner:<{widths[2]}} {group:<{widths[3]}} "
+                    f"{size:>{widths[4]}} {mtime} {name}\n"
+                )
+        print("Listed directory.")
+    except OSError as e:
+        print(f"Error listing directory: {e}")
+
+def inotify_watch(directory, mask):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, os.strerror(errno), directory)
+    return fd
+
+def read_changed_files(fd):
+    buffer = os.read(fd, 64 * 1024)
+    offset = 0
+    while offset < len(buffer):
+        _, _, _, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT.size
+        yield os.fsdecode(buffer[offset:offset + name_len].rstrip(b"\0"))
+        offset += name_len
 
 def monitor_directory_changes(directory, save_list_path, wait_time):
     execute_ls_command(directory, save_list_path)
     print("Monitoring directory:", directory)
+    # One inotify watch for the whole session, instead of an
+    # 'inotifywait' process per event
+    fd = inotify_watch(directory, IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
     try:
         while True:
-            events = subprocess.run(["inotifywait", "-q", "-e", "modify,create,delete,move", directory], capture_output=True, text=True).stdout.strip().split("\n")
-            for event in events:
-                event_parts = event.split()
-                if len(event_parts) >= 3:
-                    changed_file = event_parts[2]
-                    if changed_file != "list.txt":
-                        execute_ls_command(directory, save_list_path)
-                        print(f"Updated directory listing saved to {save_list_path}")
-            time.sleep(10)
+            changed_files = set(read_changed_files(fd))
+            if changed_files - {"list.txt"}:
+                execute_ls_command(directory, save_list_path)
+                print(f"Updated directory listing saved to {save_list_path}")
+            time.sleep(wait_time)
     except KeyboardInterrupt:
         print("Monitoring stopped.")
+    finally:
+        os.close(fd)
 
 info_file_path = "/etc/default/tftpd-hpa"
 tftp_directory = extract_tftp_directory(info_file_path)
@@ -49,5 +137,5 @@ tftp_directory = tftp_directory.strip('"')
 save_list_path = os.path.join(tftp_directory, "list.txt")
 execute_ls_command(tftp_directory, save_list_path)
 print(f"Initial directory listing saved to {save_list_path}")
-wait_time = 10 
-monitor_directory_changes(tftp_directory, save_list_path, wait_time)
\ No newline at end of file
+wait_time = 10
+monitor_directory_changes(tftp_directory, save_list_path, wait_time)
@@ -0,0 +1,244 @@
+"""
+
+Batched UDP I/O: sends and receives several datagrams with a single
+'sendmmsg'/'recvmmsg' system call (Linux), instead of one 'sendto' or
+'recvfrom' per datagram. Where these calls aren't available, falls
+back to the regular socket methods.
+
+"""
+import ctypes
+import ctypes.util
+import select
+import socket
+import struct
+import sys
+
+###############################################################
+##                                                           ##
+##                  C STRUCTURES AND LIBC                    ##
+##                                                           ##
+###############################################################
+
+MSG_DONTWAIT = 0x40
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+#:
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+#:
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+#:
+
+SOCKADDR_IN_LEN = 16
+
+def _load_libc():
+    # The structures above have the Linux layout (the BSDs, which also
+    # have these calls, use narrower 'msg_iovlen'/'msg_controllen')
+    if not sys.platform.startswith('linux'):
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg, recvmmsg = libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None, None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    return sendmmsg, recvmmsg
+#:
+
+_sendmmsg, _recvmmsg = _load_libc()
+HAS_MMSG = _sendmmsg is not None
+
+###############################################################
+##                                                           ##
+##                    BATCHED SEND/RECEIVE                   ##
+##                                                           ##
+###############################################################
+
+class DatagramBatch:
+    """
+    Holds the 'mmsghdr'/'iovec' arrays, and the receive buffers, for up
+    to 'capacity' datagrams of at most 'bufsize' bytes ('bufsize' is
+    only needed to receive). The arrays are allocated once and reused
+    by every 'send'/'recv'.
+
+    Datagrams are received straight into a ring of 'ring_len' buffers
+    (by default, 'capacity') and returned as memoryviews of it, with no
+    copies. A view is valid until 'ring_len' more datagrams have been
+    received.
+    """
+    def __init__(self, capacity: int, bufsize: int = 0, ring_len: int | None = None):
+        self.capacity = capacity
+        self.bufsize = bufsize
+        self.ring_len = max(ring_len or capacity, capacity)
+        self._addr = None
+        self._sockaddr = None
+        self._poller = None
+        self._poller_fd = None
+
+        self._send_msgs, self._send_iovs = _alloc_msgs(capacity)
+
+        self._recv_msgs, self._recv_iovs = _alloc_msgs(capacity)
+        self._names = ctypes.create_string_buffer(SOCKADDR_IN_LEN * capacity)
+        names = ctypes.addressof(self._names)
+        for i in range(capacity):
+            self._recv_msgs[i].msg_hdr.msg_name = names + i * SOCKADDR_IN_LEN
+            self._recv_msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_LEN
+            self._recv_iovs[i].iov_len = bufsize
+
+        self._ring = bytearray(bufsize * self.ring_len)
+        self._ring_view = memoryview(self._ring)
+        self._ring_c = (ctypes.c_char * len(self._ring)).from_buffer(self._ring)
+        ring_addr = ctypes.addressof(self._ring_c)
+        self._slot_addrs = [ring_addr + i * bufsize for i in range(self.ring_len)]
+        self._next_slot = 0
+    #:
+
+    def send(self, sock: socket.socket, packets: list[bytes], addr: tuple[str, int] | None = None):
+        """
+        Sends 'packets' to the numeric IPv4 address 'addr', or to the
+        address 'sock' is connected to if 'addr' is None.
+        """
+        if not HAS_MMSG or len(packets) <= 1:
+            for packet in packets:
+                _send(sock, packet, addr)
+            return
+
+        if addr is None:
+            sockaddr, sockaddr_len = None, 0
+        else:
+            if addr != self._addr:
+                self._addr = addr
+                self._sockaddr = ctypes.create_string_buffer(_pack_sockaddr_in(addr), SOCKADDR_IN_LEN)
+            sockaddr, sockaddr_len = ctypes.addressof(self._sockaddr), SOCKADDR_IN_LEN
+
+        sent = 0
+        while sent < len(packets):
+            batch = packets[sent:sent + self.capacity]
+            for i, packet in enumerate(batch):
+                hdr = self._send_msgs[i].msg_hdr
+                hdr.msg_name = sockaddr
+                hdr.msg_namelen = sockaddr_len
+                self._send_iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+                self._send_iovs[i].iov_len = len(packet)
+            count = _sendmmsg(sock.fileno(), self._send_msgs, len(batch), MSG_DONTWAIT)
+            if count <= 0:
+                # Socket buffer full (or error): let 'send' block or raise
+                _send(sock, batch[0], addr)
+                count = 1
+            sent += count
+    #:
+
+    def recv(self, sock: socket.socket) -> list[tuple[memoryview, tuple[str, int]]]:
+        """
+        Returns the datagrams already waiting in 'sock', up to 'capacity',
+        without blocking. Returns an empty list if there are none, or if
+        'recvmmsg' isn't available.
+        """
+        if not HAS_MMSG:
+            return []
+
+        first_slot = self._next_slot
+        for i in range(self.capacity):
+            self._recv_iovs[i].iov_base = self._slot_addrs[(first_slot + i) % self.ring_len]
+
+        count = _recvmmsg(sock.fileno(), self._recv_msgs, self.capacity, MSG_DONTWAIT, None)
+        if count <= 0:
+            return []
+
+        raw_names = self._names.raw
+        packets = []
+        for i in range(count):
+            msg = self._recv_msgs[i]
+            offset = (first_slot + i) % self.ring_len * self.bufsize
+            packet = self._ring_view[offset:offset + msg.msg_len]
+            packets.append((packet, _unpack_sockaddr_in(raw_names, i * SOCKADDR_IN_LEN)))
+            # The kernel overwrites it with the length of the address
+            msg.msg_hdr.msg_namelen = SOCKADDR_IN_LEN
+        self._next_slot = (first_slot + count) % self.ring_len
+        return packets
+    #:
+
+    def recv_wait(self, sock: socket.socket, timeout: float) -> list[tuple[memoryview, tuple[str, int]]]:
+        """
+        Waits up to 'timeout' seconds for at least one datagram and
+        returns it along with any others already waiting, up to
+        'capacity'. That is, one 'poll' and one 'recvmmsg' for the whole
+        batch. Raises 'socket.timeout' if nothing arrives.
+        """
+        if not HAS_MMSG:
+            sock.settimeout(timeout)
+            return [self._recvfrom_slot(sock)]
+
+        fd = sock.fileno()
+        if fd != self._poller_fd:
+            self._poller = select.poll()
+            self._poller.register(fd, select.POLLIN)
+            self._poller_fd = fd
+
+        while True:
+            if not self._poller.poll(timeout * 1000):
+                raise socket.timeout('timed out')
+            packets = self.recv(sock)
+            if packets:
+                return packets
+            # Readable but nothing to read means a pending socket error
+            # (eg, ICMP port unreachable): let 'recvfrom' raise it
+            sock.settimeout(0.001)
+            try:
+                return [self._recvfrom_slot(sock)]
+            except socket.timeout:
+                pass
+    #:
+
+    def _recvfrom_slot(self, sock: socket.socket) -> tuple[memoryview, tuple[str, int]]:
+        offset = self._next_slot * self.bufsize
+        nbytes, addr = sock.recvfrom_into(self._ring_view[offset:offset + self.bufsize])
+        self._next_slot = (self._next_slot + 1) % self.ring_len
+        return self._ring_view[offset:offset + nbytes], addr
+    #:
+#:
+
+def _send(sock: socket.socket, packet: bytes, addr: tuple[str, int] | None):
+    if addr is None:
+        sock.send(packet)
+    else:
+        sock.sendto(packet, addr)
+#:
+
+def _alloc_msgs(capacity: int):
+    msgs = (_MMsgHdr * capacity)()
+    iovs = (_IOVec * capacity)()
+    for i in range(capacity):
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return msgs, iovs
+#:
+
+def _pack_sockaddr_in(addr: tuple[str, int]) -> bytes:
+    ip, port = addr
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H4s8x', port, socket.inet_aton(ip))
+#:
+
+def _unpack_sockaddr_in(raw: bytes, offset: int) -> tuple[str, int]:
+    port, ip = struct.unpack_from('!H4s', raw, offset + 2)
+    return socket.inet_ntoa(ip), port
+#:
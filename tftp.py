@@ -6,10 +6,15 @@ definitions, methods and protocol operations.
 """
 import sys
 import os
+import errno
 import socket
 import string
 import struct
+import time
+from collections import deque
+from functools import partial
 from tqdm import tqdm
+from mmsg import DatagramBatch
 
 ###############################################################
 ##                                                           ##
@@ -18,10 +23,27 @@ from tqdm import tqdm
 ###############################################################
 
 MAX_DATA_LEN = 512           # bytes    
+MAX_BLOCK_SIZE = 65464       # bytes, largest 'blksize' (RFC 2348)
+DEFAULT_BLOCK_SIZE = 1468    # bytes, fills a 1500 bytes Ethernet MTU
 MAX_BLOCK_NUMBER = 2**16 - 1 # 0..65535
 INACTIVITY_TIMEOUT = 60.0    # segs
+RETRANSMIT_TIMEOUT = 1.0     # segs
+MAX_RETRIES = int(INACTIVITY_TIMEOUT / RETRANSMIT_TIMEOUT)
 DEFAULT_MODE = 'octet'
-DEFAULT_BUFFER_SIZE = 1024   # bytes
+DEFAULT_BUFFER_SIZE = 2048   # bytes
+DEFAULT_WINDOW_SIZE = 16     # blocks per ACK (RFC 7440)
+MAX_BATCH_LEN = 64           # datagrams per sendmmsg/recvmmsg
+DUP_ACK_THRESHOLD = 3        # duplicate ACKs that trigger a retransmit (lock-step)
+MAX_IOV_LEN = 1024           # buffers per writev (IOV_MAX on Linux)
+PROGRESS_STEP = 64 * 1024    # bytes between progress bar updates
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024  # bytes, room for a few windows in flight
+MIN_BLOCK_SIZE = 8           # bytes, smallest 'blksize' (RFC 2348)
+HEADERS_LEN = 32             # bytes, IPv4 + UDP + TFTP DAT headers
+
+# Path MTU discovery (Linux, <linux/in.h>), not in every 'socket' module
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
 
 # TFTP message opcodes
 
@@ -36,6 +58,8 @@ ERR = 5 # Error packet: what the server responds if a read/write
         # numeric error code, followed by and ASCII error message that
         # might contain additional, operating system specific 
         # information.
+OACK = 6 # Option Acknowledgment (RFC 2347): the server's reply to a
+         # RRQ/WRQ carrying options, listing the ones it accepted.
 
 
 ERR_NOT_DEFINED = 0
@@ -46,6 +70,7 @@ ILLEGAL_TFTP_OP = 4
 UNKOWN_TRANSF_ID = 5
 FILE_ALREADY_EXISTS = 6
 NO_SUCH_USER = 7
+OPTION_NEGOTIATION_FAILED = 8  # RFC 2347
 
 ERROR_MESSAGES = {
     ERR_NOT_DEFINED: 'Not defined, see error message(if any).',
@@ -55,14 +80,88 @@ ERROR_MESSAGES = {
     ILLEGAL_TFTP_OP: 'Illegal TFTP operation',
     UNKOWN_TRANSF_ID: 'Unkown Transfer ID',
     FILE_ALREADY_EXISTS: 'File already exists',
-    NO_SUCH_USER: 'No such user'
+    NO_SUCH_USER: 'No such user',
+    OPTION_NEGOTIATION_FAILED: 'Option negotiation failed',
 
 }
 
+###############################################################
+##                                                           ##
+##                        UDP SOCKETS                        ##
+##                                                           ##
+###############################################################
+
+def new_socket() -> socket.socket:
+    """
+    Creates the UDP socket for one transfer, with send and receive
+    buffers large enough for the windows in flight. The buffers are
+    capped by the kernel (net.core.rmem_max and wmem_max on Linux).
+    On Linux, packets are never fragmented: a block too big for the
+    path fails with EMSGSIZE instead.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    if sys.platform.startswith('linux'):
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+    return sock
+#:
+
+def fit_blksize(server_addr: tuple, blksize: int) -> int:
+    """
+    Returns 'blksize', or less if DAT packets of that size don't fit
+    the MTU of the route to 'server_addr' (Linux only). This is the
+    block size to ask for, since packets aren't fragmented.
+    """
+    if not sys.platform.startswith('linux'):
+        return blksize
+    # Connecting a UDP socket sends nothing, it only looks up the route
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(server_addr)
+            mtu = probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError:
+            return blksize
+    return max(min(blksize, mtu - HEADERS_LEN), MIN_BLOCK_SIZE)
+#:
+
+class SocketPool:
+    """
+    A few sockets created in advance, for a session with several
+    transfers. Each transfer needs a socket of its own: the socket is
+    connected to the server's TID, and a new transfer must use a new
+    TID (RFC 1350). So 'take' hands out a socket for good (the
+    transfer closes it) and 'refill' replaces it between transfers.
+    """
+    def __init__(self, size: int = 2):
+        self.size = size
+        self._sockets = deque(new_socket() for _ in range(size))
+    #:
+
+    def take(self) -> socket.socket:
+        return self._sockets.popleft() if self._sockets else new_socket()
+    #:
+
+    def refill(self):
+        while len(self._sockets) < self.size:
+            self._sockets.append(new_socket())
+    #:
+
+    def close(self):
+        while self._sockets:
+            self._sockets.popleft().close()
+    #:
+#:
+
 #### Função de verificão de ficheiro no servidor ##############
 
-def check_remote_file(server: str, port: int, remote_filename: str) -> bool:
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+def check_remote_file(server: str, port: int, remote_filename: str,
+                      sock: socket.socket | None = None) -> bool:
+    """
+    Checks that 'remote_filename' exists on the server. Uses 'sock' if
+    given (eg, from a SocketPool), and closes it at the end.
+    """
+    with sock or new_socket() as sock:
         sock.settimeout(INACTIVITY_TIMEOUT)
         rrq = pack_rrq(remote_filename)
         sock.sendto(rrq, (server, port))
@@ -104,191 +203,477 @@ def check_remote_file(server: str, port: int, remote_filename: str) -> bool:
 
 ################## Função GET #################################
 
-def get_file(server: str, port: int, remote_filename: str, local_filename: str = None):
+def get_file(server: str, port: int, remote_filename: str, local_filename: str = None,
+             windowsize: int = DEFAULT_WINDOW_SIZE, blksize: int = DEFAULT_BLOCK_SIZE,
+             sock: socket.socket | None = None):
     """
     Obtém o arquivo remoto dado por 'remote_filename' do servidor
-    através de uma conexão TFTP RRQ.
+    através de uma conexão TFTP RRQ. Usa 'sock', se dado, e fecha-o
+    no fim.
     """
  
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(INACTIVITY_TIMEOUT)
-        rrq = pack_rrq(remote_filename)
-        sock.sendto(rrq, (server, port))
-        with open(local_filename, 'wb') as out_file:
-            block_number = 1
-            file_size = 0
+    with sock or new_socket() as sock:
+        sock.settimeout(RETRANSMIT_TIMEOUT)
+        blksize = fit_blksize((server, port), blksize)
+        options = {'windowsize': windowsize, 'blksize': blksize, 'tsize': 0}
+        rrq = pack_rrq(remote_filename, options=options)
+        # Unbuffered: blocks are written with 'os.writev' one window at a time
+        with open(local_filename, 'wb', buffering=0) as out_file:
             print(f"Downloading '{remote_filename}' from server {server}...")                
-            with tqdm(desc="Downloading", unit="B", unit_scale=False, colour="red") as pbar:
-                while True:
-                    try:
-                        # Receive data from the server
-                        dat_packet, server_addr = sock.recvfrom(DEFAULT_BUFFER_SIZE)
- 
-                        dat_opcode = unpack_opcode(dat_packet)
- 
-                        if dat_opcode == DAT:
-                            dat_block_number, data = unpack_dat(dat_packet)
- 
-                            if dat_block_number == block_number:
-                                out_file.write(data)
-                                ack_packet = pack_ack(block_number)
-                                sock.sendto(ack_packet, server_addr)
- 
-                                pbar.update(len(data))
-                                block_number += 1
-                                file_size += len(data)
- 
-                                if len(data) < MAX_DATA_LEN:
-                                    return True
-                            else:
-                                error_msg = (
-                                    f"Unexpected DAT block number: {dat_block_number}."
-                                    f"Expecting: {block_number}."
-                                )
-                                raise ProtocolError(error_msg)
- 
-                        elif dat_opcode == ERR:
-                            error_code, error_msg = unpack_err(dat_packet)
-                            raise Err(error_code, error_msg)
- 
-                        else:
-                            error_msg = (
-                                f"Invalid packet opcode: {dat_opcode}."
-                                f"Expecting {DAT=} or {ERR=}."
-                            )
- 
-                            raise ProtocolError(error_msg)
- 
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        sys.exit(1)
+            with tqdm(desc="Downloading", unit="B", unit_scale=False, colour="red",
+                      mininterval=0.1, miniters=64) as pbar:
+                try:
+                    _recv_file(sock, (server, port), rrq, options, partial(_writev_all, out_file.fileno()), pbar)
+                    return True
 
+                except Exception as e:
+                    print(f"Error: {e}")
+                    sys.exit(1)
+#:
 
+def _recv_file(sock: socket.socket, server_addr: tuple, rrq: bytes, requested: dict[str, int],
+               write_blocks, pbar=None):
+    """
+    Sends 'rrq' to 'server_addr' (with the 'requested' options) and
+    calls 'write_blocks' with each run of DAT blocks received in order,
+    a list of views that are only valid during the call. Raises Err on
+    an ERR packet, ProtocolError on a bad OACK and socket.timeout after
+    MAX_RETRIES timeouts in a row.
+    """
+    sock.sendto(rrq, server_addr)
+    server_tid = None
+    windowsize = 1
+    blksize = MAX_DATA_LEN
+    block_number = 1
+    window_count = 0
+    out_of_sequence = False
+    retries = 0
+    # Packets that don't make progress must not hold back the timeout
+    deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+    # With a window, a single wait returns every block already queued
+    batch = DatagramBatch(1, DEFAULT_BUFFER_SIZE, ring_len=2)
+    pending = deque()
+    flush_len = 1
+    unwritten = []       # blocks not yet written, views of the ring
+    received = 0         # packets received since the oldest of them
+    progress = 0         # bytes not yet shown in 'pbar'
+    # What the loop uses for every block, looked up once
+    next_packet = pending.popleft
+    append_block = unwritten.append
+    unpack_header = _HH.unpack_from
+    ack_table = _ACK_TABLE    # 'pack_ack' is left to the paths off the in-order one
+    send = sock.send
+    monotonic = time.monotonic
+    max_block_number = MAX_BLOCK_NUMBER
+
+    while True:
+        if pending:
+            packet, addr = next_packet()
+        else:
+            if received + batch.capacity > batch.ring_len:
+                # The next packets would overwrite blocks still unwritten
+                write_blocks(unwritten)
+                unwritten.clear()
+                received = 0
+            timeout = max(deadline - monotonic(), 0.001)
+            try:
+                pending.extend(batch.recv_wait(sock, timeout))
+                received += len(pending)
+                packet, addr = next_packet()
+            except socket.timeout:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                if server_tid is None:
+                    sock.sendto(rrq, server_addr)
+                else:
+                    send(pack_ack(_prev_block(block_number)))
+                window_count = 0
+                out_of_sequence = False
+                deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+                continue
+
+        if server_tid is None:
+            server_tid = _connect_tid(sock, addr)
+
+        # The DAT header (opcode and block number) in a single unpack,
+        # instead of 'unpack_opcode' followed by 'unpack_dat'. A packet
+        # too short for it is handled as an unexpected one (below).
+        if len(packet) >= 4:
+            opcode, dat_block_number = unpack_header(packet)
+        else:
+            opcode, dat_block_number = None, None
+
+        if opcode == DAT:
+            data = packet[4:]
+
+            if dat_block_number == block_number:
+                append_block(data)
+                data_len = len(data)
+                progress += data_len
+
+                if data_len < blksize:
+                    # Last block: acknowledge first, so that the server
+                    # can end the transfer while the rest is written
+                    send(ack_table[block_number])
+                    write_blocks(unwritten)
+                    if pbar is not None:
+                        pbar.update(progress)
+                    return
+
+                retries = 0
+                deadline = monotonic() + RETRANSMIT_TIMEOUT
+                window_count += 1
+                out_of_sequence = False
+
+                if window_count == windowsize:
+                    send(ack_table[block_number])
+                    window_count = 0
+
+                if window_count == 0 or len(unwritten) == flush_len:
+                    write_blocks(unwritten)
+                    unwritten.clear()
+                    received = len(pending)
+                    if pbar is not None and progress >= PROGRESS_STEP:
+                        pbar.update(progress)
+                        progress = 0
+
+                block_number = (block_number + 1) % (max_block_number + 1)
+
+            # In lock-step mode a repeated block means our ACK was lost:
+            # it's answered every time, as the server resends it only
+            # on its timeout
+            elif windowsize == 1 and dat_block_number == _prev_block(block_number):
+                send(pack_ack(dat_block_number))
+
+            elif not out_of_sequence:
+                send(pack_ack(_prev_block(block_number)))
+                window_count = 0
+                out_of_sequence = True
+
+        elif opcode == OACK and block_number == 1 and window_count == 0:
+            options = _accept_oack(sock, packet, requested)
+            windowsize = options.get('windowsize', 1)
+            blksize = options.get('blksize', MAX_DATA_LEN)
+            flush_len = min(windowsize, MAX_IOV_LEN)
+            capacity = min(windowsize, MAX_BATCH_LEN)
+            buffer_size = max(blksize + 4, DEFAULT_BUFFER_SIZE)
+            batch = DatagramBatch(capacity, buffer_size, ring_len=flush_len + capacity)
+            received = len(pending)
+            if pbar is not None and 'tsize' in options:
+                pbar.total = options['tsize']
+                pbar.refresh()
+            send(pack_ack(0))
+            deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+
+        elif opcode == ERR:
+            error_code, error_msg = unpack_err(packet)
+            raise Err(error_code, error_msg)
+
+        # Anything else (eg, a late OACK) is answered like a block out of
+        # sequence: the ACK of the last block received triggers the
+        # retransmission, instead of aborting the transfer
+        elif not out_of_sequence:
+            send(pack_ack(_prev_block(block_number)))
+            window_count = 0
+            out_of_sequence = True
 #:
 
 ################## Função PUT #################################
 
 
-def put_file(server: str, port: int, local_filename: str, remote_filename: str = None):
+def put_file(server: str, port: int, local_filename: str, remote_filename: str = None,
+             windowsize: int = DEFAULT_WINDOW_SIZE, blksize: int = DEFAULT_BLOCK_SIZE,
+             sock: socket.socket | None = None):
     """
     Coloque o arquivo local dado por 'local_filename' no servidor remoto
-    através de uma conexão TFTP WRQ.
+    através de uma conexão TFTP WRQ. Usa 'sock', se dado, e fecha-o
+    no fim.
     """
     server_addr = (server, port)
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.settimeout(INACTIVITY_TIMEOUT)
-            with open(local_filename, 'rb') as in_file:
-                wrq = pack_wrq(remote_filename)
-                sock.sendto(wrq, server_addr)
-                block_number = 0
-
-                file_size = os.path.getsize(local_filename)
-                print(f"Uploading '{local_filename}' ({file_size} bytes) to server at {server}...")
-                with tqdm(total=file_size, desc="Uploading", unit="B", unit_scale=False, colour="green") as pbar:
-                    while True:
-                        ack_packet, server_addr = sock.recvfrom(DEFAULT_BUFFER_SIZE)
-                        ack_opcode = unpack_opcode(ack_packet)
-
-                        if ack_opcode == ACK:
-                            ack_block_number = unpack_ack(ack_packet)
-                            if ack_block_number == block_number:
-                                block_number += 1
-                            else:
-                                error_msg = (
-                                    f"Unexpected ACK block number: {ack_block_number}. "
-                                    f"Expecting: {block_number}."
-                                )
-                                raise ProtocolError(error_msg)
-
-                            data = in_file.read(MAX_DATA_LEN)
-                            dat_packet = pack_dat(block_number, data)
-                            sock.sendto(dat_packet, server_addr)
-
-                            pbar.update(len(data))
-
-                            if len(data) < MAX_DATA_LEN:
-                                return True
-
-                        elif ack_opcode == ERR:
-                            error_code, error_msg = unpack_err(ack_packet)
-                            raise Err(error_code, error_msg)
-
-                        else:
-                            error_msg = (
-                                f"Invalid packet opcode: {ack_opcode}. "
-                                f"Expecting {ACK=} or {ERR=}."
-                            )
-                            raise ProtocolError(error_msg)
+        with open(local_filename, 'rb') as in_file:
+            if hasattr(os, 'posix_fadvise'):
+                # Read as it is sent: lets the kernel read ahead further
+                os.posix_fadvise(in_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            file_size = os.path.getsize(local_filename)
+            blksize = fit_blksize(server_addr, blksize)
+
+            print(f"Uploading '{local_filename}' ({file_size} bytes) to server at {server}...")
+            with tqdm(total=file_size, desc="Uploading", unit="B", unit_scale=False, colour="green",
+                      mininterval=0.1, miniters=64) as pbar:
+                while True:
+                    options = {'windowsize': windowsize, 'blksize': blksize, 'tsize': file_size}
+                    wrq = pack_wrq(remote_filename, options=options)
+                    with sock or new_socket() as sock:
+                        sock.settimeout(RETRANSMIT_TIMEOUT)
+                        try:
+                            _send_file(sock, server_addr, wrq, options, in_file, pbar)
+                            return True
+
+                        # Blocks aren't fragmented (see 'new_socket'): if the path
+                        # MTU is smaller than the route's, the kernel learns it
+                        # and the transfer starts over with blocks that fit
+                        except OSError as e:
+                            if e.errno != errno.EMSGSIZE:
+                                raise
+                            smaller_blksize = fit_blksize(server_addr, blksize)
+                            if smaller_blksize >= blksize:
+                                raise
+                            try:
+                                sock.send(pack_err(ERR_NOT_DEFINED, 'Block size too big for the path'))
+                            except OSError:
+                                pass    # not connected to the server's TID yet
+                    blksize = smaller_blksize
+                    sock = None
+                    in_file.seek(0)
+                    pbar.reset(total=file_size)
 
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
- 
 #:
 
-################## Função DIR #################################
-
-def dir_file(server: str, port: int, remote_filename: str ='list.txt', local_filename: str ='list.txt'):
+def _send_file(sock: socket.socket, server_addr: tuple, wrq: bytes, requested: dict[str, int],
+               in_file, pbar=None):
     """
-    List directory on the server
+    Sends 'wrq' to 'server_addr' and then the contents of 'in_file' as
+    DAT blocks of the size accepted by the server in its OACK
+    (RFC 2348). If the server accepts the 'windowsize' option
+    (RFC 7440), up to 'windowsize' blocks are sent before waiting for
+    an ACK. An ACK for a block in the middle of the window makes the
+    remaining blocks of that window to be sent again. So does a repeated
+    ACK for the block before the window: once in window mode, or after
+    DUP_ACK_THRESHOLD duplicates in lock-step mode. The blocks of the
+    next window are read while the current one waits for its ACK. The
+    OACK is checked against 'requested', the options sent in 'wrq'.
     """
-    server_addr = (server, port)
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(INACTIVITY_TIMEOUT)
-        rrq = pack_rrq(remote_filename)
-        sock.sendto(rrq, server_addr)
-
-
-        with open(local_filename, 'wb') as out_file:
-            block_number = 1
-
+    sock.sendto(wrq, server_addr)
+    server_tid = None
+    windowsize = 1
+    blksize = MAX_DATA_LEN
+    batch = DatagramBatch(1)
+    window = deque()     # (block_number, dat_packet) not yet acknowledged
+    ahead = deque()      # (block_number, dat_packet) read but not yet sent
+    block_number = 0     # last block read from 'in_file'
+    eof = False
+    resent_for = None    # block number of the ACK that caused a resend
+    dup_acks = 0         # duplicate ACKs of the block before the window
+    retries = 0
+    # Duplicate ACKs must not hold back the timeout
+    deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+
+    while True:
+        try:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            packet, addr = sock.recvfrom(DEFAULT_BUFFER_SIZE)
+        except socket.timeout:
+            retries += 1
+            if retries > MAX_RETRIES:
+                raise
+            if server_tid is None:
+                sock.sendto(wrq, server_addr)
+            batch.send(sock, [dat_packet for _, dat_packet in window])
+            resent_for = None
+            deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+            continue
+
+        if server_tid is None:
+            server_tid = _connect_tid(sock, addr)
+
+        # The ACK header (opcode and block number) in a single unpack,
+        # instead of 'unpack_opcode' followed by 'unpack_ack'. A packet
+        # too short for it can't be any reply we expect: it's ignored.
+        if len(packet) < 4:
+            continue
+        opcode, ack_block_number = _HH.unpack_from(packet)
+
+        if opcode == OACK and block_number == 0:
+            options = _accept_oack(sock, packet, requested)
+            windowsize = options.get('windowsize', 1)
+            blksize = options.get('blksize', MAX_DATA_LEN)
+            batch = DatagramBatch(min(windowsize, MAX_BATCH_LEN))
+            ack_block_number = 0
+
+        # The server resends its OACK if it didn't get DAT 1 (RFC 2347):
+        # while nothing is acknowledged it stands for ACK 0, and the
+        # window is sent again. Any later OACK is stale and ignored.
+        elif opcode == OACK:
+            if window and window[0][0] == 1:
+                batch.send(sock, [dat_packet for _, dat_packet in window])
+                deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+            ack_block_number = None
+
+        elif opcode == ERR:
+            error_code, error_msg = unpack_err(packet)
+            raise Err(error_code, error_msg)
+
+        elif opcode != ACK:
+            error_msg = (
+                f"Invalid packet opcode: {opcode}. "
+                f"Expecting {ACK=} or {ERR=}."
+            )
+            raise ProtocolError(error_msg)
+
+        if any(n == ack_block_number for n, _ in window):
+            retries = 0
+            dup_acks = 0
+            deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+            acked_len = 0
             while True:
-                try:
-                    dat_packet, server_addr = sock.recvfrom(DEFAULT_BUFFER_SIZE)
-                    dat_opcode = unpack_opcode(dat_packet)
+                n, dat_packet = window.popleft()
+                acked_len += len(dat_packet) - 4
+                if n == ack_block_number:
+                    break
+            if pbar is not None:
+                pbar.update(acked_len)
+            batch.send(sock, [dat_packet for _, dat_packet in window])
+            resent_for = ack_block_number if window else None
+
+        # An ACK for the block before the window means none of it got
+        # through. In lock-step mode this is just a duplicate ACK, and
+        # answering it would cause the "Sorcerer's Apprentice" bug. The
+        # window is resent once per ACK, so that every out of order
+        # block seen by the server doesn't trigger yet another window.
+        elif (windowsize > 1 and window and ack_block_number != resent_for
+              and ack_block_number == _prev_block(window[0][0])):
+            batch.send(sock, [dat_packet for _, dat_packet in window])
+            resent_for = ack_block_number
+            deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+
+        # Fast retransmit: in lock-step mode the block is only resent
+        # after DUP_ACK_THRESHOLD duplicates, not on each one, which
+        # still avoids the "Sorcerer's Apprentice" bug but doesn't wait
+        # for the timeout when the server keeps asking for it
+        elif window and ack_block_number == _prev_block(window[0][0]):
+            dup_acks += 1
+            if dup_acks == DUP_ACK_THRESHOLD:
+                batch.send(sock, [dat_packet for _, dat_packet in window])
+                dup_acks = 0
+                deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+
+        if eof and not window and not ahead:
+            return
+
+        if not window:
+            deadline = time.monotonic() + RETRANSMIT_TIMEOUT
+        if not eof:
+            block_number, eof = _read_blocks(in_file, ahead, windowsize - len(window), block_number, blksize)
+        new_packets = []
+        while ahead and len(window) < windowsize:
+            window.append(ahead.popleft())
+            new_packets.append(window[-1][1])
+        batch.send(sock, new_packets)
+
+        # The next window is read from disk while this one is in flight,
+        # so that after an ACK it's sent at once
+        if not eof:
+            block_number, eof = _read_blocks(in_file, ahead, windowsize, block_number, blksize)
+#:
 
-                    if dat_opcode == DAT:
-                        dat_block_number, data = unpack_dat(dat_packet)
+def _read_blocks(in_file, ahead: deque, count: int, block_number: int, blksize: int) -> tuple[int, bool]:
+    """
+    Reads blocks of 'in_file', numbered after 'block_number', into
+    'ahead' as (block_number, dat_packet) until it holds 'count' of
+    them. Returns the number of the last block read and whether it was
+    the last block of the file.
+    """
+    eof = False
+    while not eof and len(ahead) < count:
+        data = in_file.read(blksize)
+        block_number = _next_block(block_number)
+        ahead.append((block_number, pack_dat(block_number, data)))
+        eof = len(data) < blksize
+    return block_number, eof
+#:
 
-                        if dat_block_number == block_number:
-                            out_file.write(data)
-                            ack_packet = pack_ack(block_number)
-                            sock.sendto(ack_packet, server_addr)
+################## Função DIR #################################
 
-                            block_number += 1
+def dir_file(server: str, port: int, remote_filename: str ='list.txt',
+             sock: socket.socket | None = None) -> bytes:
+    """
+    List directory on the server: returns the contents of
+    'remote_filename', received in memory. Uses 'sock' if given, and
+    closes it at the end.
+    """
+    server_addr = (server, port)
+    with sock or new_socket() as sock:
+        sock.settimeout(RETRANSMIT_TIMEOUT)
+        blksize = fit_blksize(server_addr, DEFAULT_BLOCK_SIZE)
+        options = {'windowsize': DEFAULT_WINDOW_SIZE, 'blksize': blksize}
+        rrq = pack_rrq(remote_filename, options=options)
 
-                            if len(data) < MAX_DATA_LEN:
-                                
-                                break
+        listing = bytearray()
+        try:
+            _recv_file(sock, server_addr, rrq, options, partial(_extend_all, listing))
+            return bytes(listing)
 
-                        else:
-                            error_msg = (
-                                f"Unexpected DAT block number: {dat_block_number}."
-                                f"Expecting: {block_number}."
-                            )
-                            raise ProtocolError(error_msg)
+        except socket.timeout:
+            print("\nServer not responding. Exiting.")
+            sys.exit(1)
 
-                    elif dat_opcode == ERR:
-                        error_code, error_msg = unpack_err(dat_packet)
-                        raise Err(error_code, error_msg)
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+#:
 
-                    else:
-                        error_msg = (
-                            f"Invalid packet opcode: {dat_opcode}."
-                            f"Expecting {DAT=} or {ERR=}."
-                        )
+def _connect_tid(sock: socket.socket, addr: tuple) -> tuple:
+    """
+    Connects 'sock' to 'addr', the port the server answers from (its
+    TID), and returns it. From then on the kernel drops packets from
+    any other address and there's no destination to look up per packet.
+    """
+    sock.connect(addr)
+    return addr
+#:
 
-                        raise ProtocolError(error_msg)
+def _accept_oack(sock: socket.socket, packet: bytes, requested: dict[str, int]) -> dict[str, int]:
+    """
+    Returns the options of the OACK 'packet', if the server only
+    accepted options from 'requested' and didn't raise their values
+    (RFC 2347). Otherwise, sends ERR 8 to the server and raises
+    ProtocolError.
+    """
+    options = unpack_oack(packet)
+    error_msg = None
+    for name, value in options.items():
+        if name not in requested:
+            error_msg = f"Option '{name}' not requested"
+        elif name == 'windowsize' and not 1 <= value <= requested[name]:
+            error_msg = f"Invalid windowsize {value}"
+        elif name == 'blksize' and not MIN_BLOCK_SIZE <= value <= min(requested[name], MAX_BLOCK_SIZE):
+            error_msg = f"Invalid blksize {value}"
+        if error_msg:
+            sock.send(pack_err(OPTION_NEGOTIATION_FAILED, error_msg))
+            raise ProtocolError(f"Option negotiation failed: {error_msg}")
+    return options
+#:
 
-                except socket.timeout:
-                    print("\nServer not responding. Exiting.")
-                    sys.exit(1)
+def _writev_all(fd: int, buffers: list):
+    """
+    Writes all of 'buffers' to 'fd' with a single 'os.writev'.
+    """
+    written = os.writev(fd, buffers)
+    total = sum(len(buffer) for buffer in buffers)
+    if written < total:
+        # Short write: finish it with the (rarely needed) slow path
+        os.write(fd, b''.join(buffers)[written:])
+#:
 
-                except Exception as e:
-                    print(f"Error: {e}")
-                    sys.exit(1)
+def _extend_all(out: bytearray, buffers: list):
+    """
+    Appends all of 'buffers' to 'out', the in memory '_writev_all'.
+    """
+    for buffer in buffers:
+        out.extend(buffer)
+#:
+
+def _next_block(block_number: int) -> int:
+    return (block_number + 1) % (MAX_BLOCK_NUMBER + 1)
+#:
 
+def _prev_block(block_number: int) -> int:
+    return (block_number - 1) % (MAX_BLOCK_NUMBER + 1)
 #:
 
 ##############################################################
@@ -297,18 +682,29 @@ def dir_file(server: str, port: int, remote_filename: str ='list.txt', local_fil
 ##                                                          ##
 ############################################################## 
 
-def pack_rrq(filename: str, mode: str = DEFAULT_MODE) -> bytes:
-    return _pack_rrq_wrq(RRQ, filename, mode)
+# Precompiled formats for the opcode and the opcode + block number/error
+# code header, and every possible ACK packet (128 KiB), built once
+_H = struct.Struct('!H')
+_HH = struct.Struct('!HH')
+_ACK_TABLE = [_HH.pack(ACK, block_number) for block_number in range(MAX_BLOCK_NUMBER + 1)]
+# Indexed by opcode (0 to OACK): whether it's a valid opcode
+_VALID_OPCODES = (False, True, True, True, True, True, True)
+
+def pack_rrq(filename: str, mode: str = DEFAULT_MODE, options: dict[str, int] | None = None) -> bytes:
+    return _pack_rrq_wrq(RRQ, filename, mode, options)
 #:
 
 
-def _pack_rrq_wrq(opcode: int, filename: str, mode: str = DEFAULT_MODE) -> bytes:
+def _pack_rrq_wrq(opcode: int, filename: str, mode: str = DEFAULT_MODE,
+                  options: dict[str, int] | None = None) -> bytes:
     if not is_ascii_printable(filename):
         raise TFTPValueError(f"Invalid filename: {filename}. Not ASCII printable")
-    filename_bytes = filename.encode() + b'\x00'
-    mode_bytes = mode.encode() + b'\x00'
-    fmt = f'!H{len(filename_bytes)}s{len(mode_bytes)}s'
-    return struct.pack(fmt, opcode, filename_bytes, mode_bytes)
+    return b''.join((
+        _H.pack(opcode),
+        filename.encode(), b'\x00',
+        mode.encode(), b'\x00',
+        _pack_options(options or {}),
+    ))
 #:
 
 def unpack_rrq(packet: bytes) -> tuple[str, str]:
@@ -321,24 +717,52 @@ def _unpack_rrq_wrq(opcode: int, packet: bytes) -> tuple[str, str]:
         raise TFTPValueError(f'Invalid opcode: {received_opcode}. Expected opcode: {opcode}')
     delim_pos = packet.index(b'\x00', 2)
     filename = packet[2: delim_pos].decode()
-    mode = packet[delim_pos + 1:-1].decode()
+    mode_end = packet.index(b'\x00', delim_pos + 1)
+    mode = packet[delim_pos + 1:mode_end].decode()
     return filename, mode
 #:
 
+def pack_oack(options: dict[str, int]) -> bytes:
+    return _H.pack(OACK) + _pack_options(options)
+#:
+
+def unpack_oack(packet: bytes) -> dict[str, int]:
+    opcode, = _H.unpack_from(packet)
+    if opcode != OACK:
+        raise TFTPValueError(f'Invalid opcode: {opcode}. Expected opcode: {OACK=}')
+    fields = bytes(packet[2:]).split(b'\x00')[:-1]
+    if len(fields) % 2:
+        raise TFTPValueError('Invalid OACK: option without value')
+    try:
+        return {
+            name.decode().lower(): int(value)
+            for name, value in zip(fields[::2], fields[1::2])
+        }
+    except ValueError:
+        raise TFTPValueError(f'Invalid OACK option value in {packet[2:]!r}')
+#:
+
+def _pack_options(options: dict[str, int]) -> bytes:
+    return b''.join(
+        name.encode() + b'\x00' + str(value).encode() + b'\x00'
+        for name, value in options.items()
+    )
+#:
+
 def pack_dat(block_number:int, data: bytes) -> bytes:
     if not 0 <= block_number <= MAX_BLOCK_NUMBER:
         err_msg = f'Block number {block_number} larger than allowed ({MAX_BLOCK_NUMBER})'
         raise TFTPValueError(err_msg)
-    if len(data) > MAX_DATA_LEN:
-        err_msg = f'Data size {block_number} larger than allowed ({MAX_DATA_LEN})'
+    if len(data) > MAX_BLOCK_SIZE:
+        err_msg = f'Data size {len(data)} larger than allowed ({MAX_BLOCK_SIZE})'
         raise TFTPValueError(err_msg)
     
-    fmt = f'!HH{len(data)}s'
-    return struct.pack(fmt, DAT, block_number, data)
+    return _HH.pack(DAT, block_number) + data
 #:
 
-def unpack_dat(packet: bytes) -> tuple[int, bytes]:
-    opcode, block_number = struct.unpack('!HH', packet[:4])
+def unpack_dat(packet: bytes | memoryview) -> tuple[int, bytes | memoryview]:
+    # For a memoryview, the data is a view of it too: no copies
+    opcode, block_number = _HH.unpack_from(packet)
     if opcode != DAT:
         raise TFTPValueError(f'Invalid opcode {opcode}. Expecting {DAT=}.')
     return block_number, packet[4:]
@@ -349,11 +773,11 @@ def pack_ack(block_number: int) -> bytes:
         err_msg = f'Block number {block_number} larger than allowed ({MAX_BLOCK_NUMBER})'
         raise TFTPValueError(err_msg)
     
-    return struct.pack(f'!HH', ACK, block_number)
+    return _ACK_TABLE[block_number]
 #:
 
 def unpack_ack(packet: bytes) -> int:
-    opcode, block_number = struct.unpack('!HH', packet)
+    opcode, block_number = _HH.unpack_from(packet)
     if opcode != ACK:
         raise TFTPValueError(f'Invalid opcode {opcode}. Expecting {DAT=}.')
     return block_number
@@ -364,26 +788,24 @@ def pack_err(error_code: int, error_msg: str | None = None) -> bytes:
         raise TFTPValueError(f'Invalid error code {error_code}')
     if error_msg is None:
         error_msg = ERROR_MESSAGES[error_code]
-    error_msg_bytes = error_msg.encode() + b'\x00'
-    fmt = f'!HH{len(error_msg_bytes)}s'
-    return struct.pack(fmt, ERR, error_code, error_msg_bytes)
+    return _HH.pack(ERR, error_code) + error_msg.encode() + b'\x00'
 #:
 
 def unpack_err(packet: bytes) -> tuple[int, str]:
-    opcode, error_code = struct.unpack('!HH', packet[:4])
+    opcode, error_code = _HH.unpack_from(packet)
     if opcode != ERR:
         raise TFTPValueError(f'Invalid opcode: {opcode}. Expected opcode: {ERR=}')
-    return error_code, packet[4:-1].decode()
+    return error_code, bytes(packet[4:-1]).decode()
 #:
 
 def unpack_opcode(packet: bytes) -> int:
-    opcode, *_ = struct.unpack('!H', packet[:2])
-    if opcode not in (RRQ, WRQ, DAT, ACK, ERR):
+    opcode, = _H.unpack_from(packet)
+    if opcode >= len(_VALID_OPCODES) or not _VALID_OPCODES[opcode]:
         raise TFTPValueError(f'Invalid opcode {opcode}')
     return opcode
 #:
-def pack_wrq(filename: str, mode: str = DEFAULT_MODE) -> bytes:
-    return _pack_rrq_wrq(WRQ, filename, mode)
+def pack_wrq(filename: str, mode: str = DEFAULT_MODE, options: dict[str, int] | None = None) -> bytes:
+    return _pack_rrq_wrq(WRQ, filename, mode, options)
 
 def unpack_wrq(packet: bytes) -> tuple[str, str]:
     return _unpack_rrq_wrq(WRQ, packet)
@@ -427,8 +849,10 @@ class Err(Exception):
         self.error_msg = error_msg
 #:
 
+_PRINTABLE_BYTES = string.printable.encode()
+
 def is_ascii_printable(txt: str) -> bool:
-    return set(txt).issubset(string.printable)
-    # ALTERNATIVA: return not set(txt) - set(string.printable)
+    # Deleting every printable char must leave nothing behind
+    return txt.isascii() and not txt.encode().translate(None, _PRINTABLE_BYTES)
 
 #:
\ No newline at end of file
@@ -5,34 +5,45 @@
 ##                                                           ##
 ###############################################################
 
-import subprocess
+import functools
 import socket
 import sys
 
 
 def check_server(server, server_port):
     try:
-        subprocess.run(["ping", "-c", "1", server], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Connecting a UDP socket sends nothing, but resolves the name
+        # and fails if there's no route to the server
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(resolve_sockaddr(server, server_port))
 
-    except subprocess.CalledProcessError:
+    except OSError:
         print(f"\033[41mError:\033[0m {server} is unreachable.")
         sys.exit(1)
 
 #:
 
+@functools.lru_cache(maxsize=128)
+def resolve_sockaddr(server, server_port):
+    """
+    The IPv4 (ip, port) address of 'server', resolved only once.
+    """
+    return socket.getaddrinfo(server, server_port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+
+#:
+
+@functools.lru_cache(maxsize=128)
 def resolve_server_address(server, server_port):
     try:
-        # Attempt to resolve the hostname
-        server_name = socket.gethostbyaddr(server)[0]
-        server_ip_list = socket.gethostbyaddr(server)[2]
-        server_ip = server_ip_list[0]
-        return server_name, server_ip
-    except socket.herror:
-        server_name = server
-        server_ip = server
+        # One forward lookup for the IP and one reverse lookup for the name
+        server_ip, _ = resolve_sockaddr(server, server_port)
+        try:
+            server_name = socket.gethostbyaddr(server_ip)[0]
+        except socket.herror:
+            server_name = server
         return server_name, server_ip
     except socket.error:
         print(f"\033[41mError:\033[0m Unable to resolve the server address for {server}")
         sys.exit(1)
 
-#:
\ No newline at end of file
+#: